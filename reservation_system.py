@@ -1,10 +1,12 @@
 import threading
 import queue
+import heapq
+import collections
 import time
-import uuid
+import itertools
 import random
 from dataclasses import dataclass
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence, Tuple
 
 NUM_SLOTS = 10
 HOLD_SECONDS = 5
@@ -12,57 +14,211 @@ VALIDATOR_WORKERS = 2
 PROCESSOR_WORKERS = 1
 REQUESTER_THREADS = 6
 SIMULATION_SECONDS = 20
+EXPIRY_BATCH = 4096
+QUEUE_MAXSIZE = 256
+MAX_HOLDS = 4096
+HOLD_SHARDS = 8
+USER_INDEX_SHARDS = 8
+REQUEST_POOL_SIZE = 256
+
+incoming_queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+confirm_queue = queue.SimpleQueue()
+
+FREE, HELD, BOOKED = 0, 1, 2
+STATE_NAMES = ('FREE', 'HELD', 'BOOKED')
+
+_slot_cv = threading.Condition()
+_held_mask = 0
+_state_bits = 0
+_free_mask = (1 << NUM_SLOTS) - 1
+slot_owner: List[Optional[str]] = [None] * NUM_SLOTS
+slot_hold: List[Optional[int]] = [None] * NUM_SLOTS
+
+_holds_arr: List[Optional['HoldInfo']] = [None] * MAX_HOLDS
+_hold_locks = [threading.Lock() for _ in range(HOLD_SHARDS)]
+_hold_id_gen = itertools.count(1)
+_user_index: List[Dict[str, Dict[int, int]]] = [collections.defaultdict(dict) for _ in range(USER_INDEX_SHARDS)]
+_user_locks = [threading.Lock() for _ in range(USER_INDEX_SHARDS)]
+
+_expiry_heap: List[tuple] = []
+_expiry_cv = threading.Condition()
 
-incoming_queue = queue.Queue()
-confirm_queue = queue.Queue()
-
-slot_locks: Dict[int, threading.Lock] = {}
-slots: Dict[int, Dict] = {}
+class ReserveRequest:
+    __slots__ = ('user', 'slot_ids', 'slot_mask')
 
-holds: Dict[str, Dict] = {}
-global_state_lock = threading.Lock()
+    def __init__(self, user: str, slot_ids: List[int], mask: int = 0):
+        self.user = user
+        self.slot_ids = slot_ids
+        self.slot_mask = mask
 
-@dataclass
-class ReserveRequest:
-    user: str
-    slot_ids: List[int]
-    request_id: str = None
+_req_pool = collections.deque(maxlen=REQUEST_POOL_SIZE)
 
 @dataclass
 class ConfirmRequest:
     user: str
-    hold_id: str
+    hold_id: int
+
+class HoldInfo:
+    __slots__ = ('hold_id', 'user', 'slots', 'mask', 'expires')
+
+    def __init__(self, user: str, slots: Tuple[int, ...], mask: int, expires: float):
+        self.hold_id = 0
+        self.user = user
+        self.slots = slots
+        self.mask = mask
+        self.expires = expires
+
+    def __repr__(self):
+        return f"HoldInfo(user={self.user!r}, slots={self.slots!r}, expires={self.expires:.1f})"
 
 def init_system():
+    global _state_bits, _free_mask
+    _state_bits = 0
+    _free_mask = (1 << NUM_SLOTS) - 1
     for i in range(NUM_SLOTS):
-        slot_locks[i] = threading.Lock()
-        slots[i] = {'state': 'FREE', 'held_by': None, 'hold_id': None, 'expires': None}
-
-def acquire_locks_ordered(slot_ids: List[int], timeout=1.0) -> bool:
-    ordered = sorted(slot_ids)
-    acquired = []
-    start = time.time()
-    for s in ordered:
-        remaining = timeout - (time.time() - start)
-        if remaining <= 0:
-            for a in acquired:
-                a.release()
-            return False
-        got = slot_locks[s].acquire(timeout=remaining)
-        if not got:
-            for a in acquired:
-                a.release()
-            return False
-        acquired.append(slot_locks[s])
-    return True
-
-def release_locks_ordered(slot_ids: List[int]):
-    for s in sorted(slot_ids, reverse=True):
-        if slot_locks[s].locked():
+        slot_owner[i] = None
+        slot_hold[i] = None
+
+def slot_mask(slot_ids: Sequence[int]) -> int:
+    if len(slot_ids) == 1:
+        return 1 << slot_ids[0]
+    return sum(1 << s for s in slot_ids)
+
+def state_mask(slot_ids: Sequence[int], state=0b11) -> int:
+    if len(slot_ids) == 1:
+        return state << (2 * slot_ids[0])
+    return sum(state << (2 * s) for s in slot_ids)
+
+def slot_state(s: int, bits: Optional[int] = None) -> int:
+    if bits is None:
+        bits = _state_bits
+    return (bits >> (2 * s)) & 0b11
+
+def set_slot_state(slot_ids: Sequence[int], state: int, owner: Optional[str], hold_id: Optional[int]):
+    global _state_bits, _free_mask
+    mask = slot_mask(slot_ids)
+    with _slot_cv:
+        _state_bits = (_state_bits & ~state_mask(slot_ids)) | state_mask(slot_ids, state)
+        if state == FREE:
+            _free_mask |= mask
+        else:
+            _free_mask &= ~mask
+        for s in slot_ids:
+            slot_owner[s] = owner
+            slot_hold[s] = hold_id
+
+def rent_request(user: str, slot_ids: List[int], mask: int) -> ReserveRequest:
+    try:
+        req = _req_pool.pop()
+    except IndexError:
+        return ReserveRequest(user, slot_ids, mask)
+    req.user = user
+    req.slot_ids = slot_ids
+    req.slot_mask = mask
+    return req
+
+def return_request(req: ReserveRequest):
+    req.user = None
+    req.slot_ids = None
+    req.slot_mask = 0
+    _req_pool.append(req)
+
+def put_drop_oldest(q: queue.Queue, item):
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
             try:
-                slot_locks[s].release()
-            except RuntimeError:
-                pass
+                dropped = q.get_nowait()
+            except queue.Empty:
+                continue
+            if isinstance(dropped, ReserveRequest):
+                return_request(dropped)
+
+def get_hold(hold_id: int) -> Optional[HoldInfo]:
+    info = _holds_arr[hold_id % MAX_HOLDS]
+    if info is None or info.hold_id != hold_id:
+        return None
+    return info
+
+def _user_shard(user: str) -> int:
+    return hash(user) % USER_INDEX_SHARDS
+
+def find_hold(user: str, mask: int) -> Optional[int]:
+    i = _user_shard(user)
+    with _user_locks[i]:
+        user_holds = _user_index[i].get(user)
+        return user_holds.get(mask) if user_holds else None
+
+def add_hold(info: HoldInfo) -> int:
+    while True:
+        hold_id = next(_hold_id_gen)
+        idx = hold_id % MAX_HOLDS
+        with _hold_locks[idx % HOLD_SHARDS]:
+            if _holds_arr[idx] is None:
+                info.hold_id = hold_id
+                _holds_arr[idx] = info
+                break
+    i = _user_shard(info.user)
+    with _user_locks[i]:
+        _user_index[i][info.user][info.mask] = hold_id
+    return hold_id
+
+def drop_hold(hold_id: int):
+    idx = hold_id % MAX_HOLDS
+    with _hold_locks[idx % HOLD_SHARDS]:
+        info = get_hold(hold_id)
+        if info is None:
+            return
+        _holds_arr[idx] = None
+    i = _user_shard(info.user)
+    with _user_locks[i]:
+        user_holds = _user_index[i].get(info.user)
+        if user_holds and user_holds.get(info.mask) == hold_id:
+            del user_holds[info.mask]
+
+def schedule_expiry(expires: float, hold_id: int):
+    entry = (expires, hold_id)
+    with _expiry_cv:
+        heapq.heappush(_expiry_heap, entry)
+        if _expiry_heap[0] is entry:
+            _expiry_cv.notify()
+
+def acquire_locks(mask: int, timeout=1.0) -> int:
+    global _held_mask
+    with _slot_cv:
+        if _held_mask & mask:
+            deadline = time.monotonic() + timeout
+            while _held_mask & mask:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not _slot_cv.wait(remaining):
+                    return 0
+        _held_mask |= mask
+    return mask
+
+def release_locks(mask: int):
+    global _held_mask
+    with _slot_cv:
+        _held_mask &= ~mask
+        _slot_cv.notify_all()
+
+def try_reserve(mask: int, slot_ids: Tuple[int, ...], user: str, timeout=1.0) -> int:
+    if mask & ~_free_mask:
+        return 0
+    locked = acquire_locks(mask, timeout=timeout)
+    if not locked:
+        return 0
+    try:
+        if locked & ~_free_mask:
+            return 0
+        expires = time.time() + HOLD_SECONDS
+        hold_id = add_hold(HoldInfo(user, slot_ids, mask, expires))
+        set_slot_state(slot_ids, HELD, user, hold_id)
+        schedule_expiry(expires, hold_id)
+        return hold_id
+    finally:
+        release_locks(locked)
 
 class ValidatorThread(threading.Thread):
     def __init__(self, wid:int):
@@ -71,38 +227,14 @@ class ValidatorThread(threading.Thread):
 
     def run(self):
         while True:
-            try:
-                req: ReserveRequest = incoming_queue.get(timeout=1)
-            except queue.Empty:
-                continue
-            if not all(0 <= s < NUM_SLOTS for s in req.slot_ids):
-                continue
+            req: ReserveRequest = incoming_queue.get()
+            self.handle(req)
+            return_request(req)
 
-            got_all = acquire_locks_ordered(req.slot_ids, timeout=1.0)
-            if not got_all:
-                continue
-
-            with global_state_lock:
-                conflict = False
-                for s in req.slot_ids:
-                    if slots[s]['state'] != 'FREE':
-                        conflict = True
-                        break
-                if conflict:
-                    release_locks_ordered(req.slot_ids)
-                    continue
-
-                hold_id = str(uuid.uuid4())
-                expires = time.time() + HOLD_SECONDS
-                for s in req.slot_ids:
-                    slots[s]['state'] = 'HELD'
-                    slots[s]['held_by'] = req.user
-                    slots[s]['hold_id'] = hold_id
-                    slots[s]['expires'] = expires
-                holds[hold_id] = {'user': req.user, 'slots': list(req.slot_ids), 'expires': expires}
-
-            release_locks_ordered(req.slot_ids)
-            incoming_queue.task_done()
+    def handle(self, req: ReserveRequest):
+        if not all(0 <= s < NUM_SLOTS for s in req.slot_ids):
+            return
+        try_reserve(req.slot_mask, tuple(req.slot_ids), req.user)
 
 class ProcessorThread(threading.Thread):
     def __init__(self, wid:int):
@@ -111,52 +243,33 @@ class ProcessorThread(threading.Thread):
 
     def run(self):
         while True:
-            try:
-                c: ConfirmRequest = confirm_queue.get(timeout=1)
-            except queue.Empty:
-                continue
+            c: ConfirmRequest = confirm_queue.get()
 
-            hold = holds.get(c.hold_id)
+            hold = get_hold(c.hold_id)
             if not hold:
-                confirm_queue.task_done()
                 continue
 
-            if hold['user'] != c.user:
-                confirm_queue.task_done()
+            if hold.user != c.user:
                 continue
 
-            slot_ids = hold['slots']
-            got_all = acquire_locks_ordered(slot_ids, timeout=1.0)
-            if not got_all:
-                confirm_queue.task_done()
+            slot_ids = hold.slots
+            locked = acquire_locks(hold.mask, timeout=1.0)
+            if not locked:
                 continue
 
-            with global_state_lock:
-                now = time.time()
-                if hold['expires'] < now:
-                    release_locks_ordered(slot_ids)
-                    confirm_queue.task_done()
-                    continue
+            now = time.time()
+            if hold.expires < now:
+                release_locks(locked)
+                continue
 
-                conflict = False
-                for s in slot_ids:
-                    if slots[s]['state'] != 'HELD' or slots[s]['hold_id'] != c.hold_id:
-                        conflict = True
-                        break
-                if conflict:
-                    release_locks_ordered(slot_ids)
-                    confirm_queue.task_done()
-                    continue
+            if any(slot_hold[s] != c.hold_id for s in slot_ids):
+                release_locks(locked)
+                continue
 
-                for s in slot_ids:
-                    slots[s]['state'] = 'BOOKED'
-                    slots[s]['held_by'] = c.user
-                    slots[s]['hold_id'] = c.hold_id
-                    slots[s]['expires'] = None
-                del holds[c.hold_id]
+            set_slot_state(slot_ids, BOOKED, c.user, None)
+            drop_hold(c.hold_id)
 
-            release_locks_ordered(slot_ids)
-            confirm_queue.task_done()
+            release_locks(locked)
 
 class ExpiratorThread(threading.Thread):
     def __init__(self):
@@ -164,26 +277,29 @@ class ExpiratorThread(threading.Thread):
 
     def run(self):
         while True:
-            time.sleep(1)
-            now = time.time()
-            expired = []
-            with global_state_lock:
-                for hid, info in list(holds.items()):
-                    if info['expires'] < now:
-                        expired.append((hid, info))
-                for hid, info in expired:
-                    for s in info['slots']:
-                        if slot_locks[s].acquire(timeout=0.2):
-                            try:
-                                if slots[s]['hold_id'] == hid and slots[s]['state'] == 'HELD':
-                                    slots[s]['state'] = 'FREE'
-                                    slots[s]['held_by'] = None
-                                    slots[s]['hold_id'] = None
-                                    slots[s]['expires'] = None
-                            finally:
-                                slot_locks[s].release()
-                    if hid in holds:
-                        del holds[hid]
+            with _expiry_cv:
+                while not _expiry_heap:
+                    _expiry_cv.wait()
+                wait = _expiry_heap[0][0] - time.time()
+                if wait > 0:
+                    _expiry_cv.wait(timeout=wait)
+                    continue
+                now = time.time()
+                batch = []
+                while _expiry_heap and _expiry_heap[0][0] <= now and len(batch) < EXPIRY_BATCH:
+                    batch.append(heapq.heappop(_expiry_heap))
+            for expires, hid in batch:
+                info = get_hold(hid)
+                if not info:
+                    continue
+                locked = acquire_locks(info.mask, timeout=0.2)
+                if not locked:
+                    schedule_expiry(expires, hid)
+                    continue
+                freed = [s for s in info.slots if slot_hold[s] == hid]
+                set_slot_state(freed, FREE, None, None)
+                drop_hold(hid)
+                release_locks(locked)
 
 class RequesterThread(threading.Thread):
     def __init__(self, user_id:int):
@@ -195,31 +311,36 @@ class RequesterThread(threading.Thread):
         while True:
             time.sleep(self.rng.uniform(0.1, 1.0))
             k = self.rng.choice([1, 1, 2])
-            slots_req = self.rng.sample(range(NUM_SLOTS), k)
-            req = ReserveRequest(user=self.user, slot_ids=slots_req, request_id=str(uuid.uuid4()))
-            incoming_queue.put(req)
+            free = [s for s in range(NUM_SLOTS) if _free_mask & (1 << s)]
+            if len(free) < k:
+                continue
+            slots_req = self.rng.sample(free, k)
+            req_mask = slot_mask(slots_req)
+            req = rent_request(self.user, slots_req, req_mask)
+            put_drop_oldest(incoming_queue, req)
             will_confirm = self.rng.random() < 0.6
             if will_confirm:
                 time.sleep(self.rng.uniform(0.1, 2.0))
-                with global_state_lock:
-                    candidate = None
-                    for hid, info in holds.items():
-                        if info['user'] == self.user and set(info['slots']) == set(slots_req):
-                            candidate = hid
-                            break
+                candidate = find_hold(self.user, req_mask)
                 if candidate:
                     confirm_queue.put(ConfirmRequest(user=self.user, hold_id=candidate))
 
 def print_state():
-    with global_state_lock:
-        s = []
-        for i in range(NUM_SLOTS):
-            st = slots[i]['state']
-            owner = slots[i]['held_by'] or '-'
-            h = (slots[i]['hold_id'][:8] if slots[i]['hold_id'] else '-')
-            s.append(f"{i}:{st[:1]}({owner},{h})")
-        print("SLOTS:", " | ".join(s))
-        print("Active holds:", {k[:8]:v for k, v in holds.items()})
+    with _slot_cv:
+        bits = _state_bits
+        owners = list(slot_owner)
+        hold_ids = list(slot_hold)
+    snapshot = list(_holds_arr)
+    active = [h for h in snapshot if h is not None]
+
+    s = []
+    for i in range(NUM_SLOTS):
+        st = STATE_NAMES[slot_state(i, bits)]
+        owner = owners[i] or '-'
+        h = (f"{hold_ids[i]:08x}" if hold_ids[i] else '-')
+        s.append(f"{i}:{st[:1]}({owner},{h})")
+    print("SLOTS:", " | ".join(s))
+    print("Active holds:", {f"{h.hold_id:08x}": h for h in sorted(active, key=lambda h: h.hold_id)})
 
 def main():
     init_system()